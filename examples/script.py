@@ -0,0 +1,29 @@
+from pyrealtime.layer import LayerSignal
+from pyrealtime.layer_manager import LayerManager
+from pyrealtime.script_layers import ScriptProducer
+from pyrealtime.utility_layers import PrintLayer
+
+
+class TwoPromptScript(ScriptProducer):
+
+    def make_script(self):
+        return ["first prompt", "second prompt"]
+
+    def get_input(self):
+        if self.step >= len(self.script):
+            return LayerSignal.STOP
+        return super().get_input()
+
+    def do_state_prompt(self, script_entry):
+        state, data = super().do_state_prompt(script_entry)
+        data['prompt'] = script_entry
+        return state, data
+
+
+def main():
+    PrintLayer(TwoPromptScript(name="script"))
+    LayerManager.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,83 @@
-from pyrealtime.layer import TransformMixin, ThreadLayer, MultiOutputMixin
+from collections import deque
+
+from pyrealtime.layer import TransformMixin, BatchTransformMixin, ThreadLayer, MultiOutputMixin
 import numpy as np
 
+try:
+    from fastnumbers import try_array
+except ImportError:
+    try_array = None
+
 
 def comma_decoder(data):
+    tokens = data.split(b',' if isinstance(data, bytes) else ',')
+    # Converting the tokens (rather than np.fromstring) raises on blank fields instead of skipping them or
+    # filling them with -1
+    try:
+        return np.array(tokens, dtype=np.float64)
+    except ValueError:
+        return None
+
+
+def fast_comma_decoder(data, out=None):
+    tokens = data.split(b',' if isinstance(data, bytes) else ',')
     try:
-        data = np.array([float(x) for x in data.split(',')])
+        if out is not None and out.size == len(tokens):
+            try_array(tokens, output=out)
+            return out
+        data = try_array(tokens, dtype=np.float64)
     except ValueError:
         return None
     return data
 
 
+default_decoder = fast_comma_decoder if try_array is not None else comma_decoder
+
+
+# Array handed out by a DecodeLayer buffer pool. The consumer can call release() once it is done with the frame
+# so the decoder reuses the buffer instead of allocating a new one. Frames are only pooled while the layer has a
+# single consumer; otherwise, and after the first release(), release() does nothing. Views of a frame are not
+# pooled, and ufunc results and copies pickled to other processes are plain ndarrays.
+class PooledArray(np.ndarray):
+    pool = None
+
+    def __array_finalize__(self, obj):
+        self.pool = None
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple(x.view(np.ndarray) if isinstance(x, PooledArray) else x for x in inputs)
+        outputs = kwargs.get('out')
+        if outputs is not None:
+            kwargs['out'] = tuple(x.view(np.ndarray) if isinstance(x, PooledArray) else x for x in outputs)
+        result = getattr(ufunc, method)(*inputs, **kwargs)
+        if outputs is not None:
+            return outputs[0] if len(outputs) == 1 else outputs
+        return result
+
+    def __reduce__(self):
+        return self.view(np.ndarray).__reduce__()
+
+    def release(self):
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.append(self)
+
+
 class DecodeLayer(TransformMixin, MultiOutputMixin, ThreadLayer):
-    def __init__(self, port_in, decoder=comma_decoder, port_names=None, *args, **kwargs):
+    def __init__(self, port_in, decoder=None, port_names=None, pool_size=0, ring_size=None, n_channels=None,
+                 queue_capacity=4, *args, **kwargs):
+        self.queue_capacity = queue_capacity
         super().__init__(port_in, *args, **kwargs)
-        self.decode = decoder
+        self.decode = decoder if decoder is not None else default_decoder
+        self.pool = None
+        if self.decode is fast_comma_decoder and pool_size > 0 and ring_size is None:
+            self.pool = deque(maxlen=pool_size)
+        # If ring_size is given, frames are decoded into rows of a preallocated (ring_size, n_channels) buffer
+        # and emitted as views of it. A frame stays valid until ring_size newer frames have been decoded.
+        self.ring_size = ring_size
+        self.n_channels = n_channels
+        self.ring = None
+        self.ring_count = 0
         if port_names is not None:
             for port_name in port_names:
                 self._register_port(port_name)
@@ -25,6 +89,78 @@ class DecodeLayer(TransformMixin, MultiOutputMixin, ThreadLayer):
     #             self._register_port(port_name)
 
     def transform(self, data):
-        data_dict = self.decode(data)
-        return data_dict
+        if self.ring_size is not None:
+            return self.transform_ring(data)
+        if self.pool is None:
+            return self.decode(data)
+        out = self.pool.pop() if self.pool else None
+        decoded = self.decode(data, out=out)
+        if decoded is None:
+            if out is not None:
+                self.pool.append(out)
+            return None
+        if decoded is not out:
+            decoded = decoded.view(PooledArray)
+        if self.has_single_consumer():
+            decoded.pool = self.pool
+        return decoded
+
+    def has_single_consumer(self):
+        port = self.out_port
+        return len(self.port_items) == 0 and len(port.out_queues_thread) + len(port.out_queues_mp) == 1
+
+    def transform_ring(self, data):
+        if self.ring is not None and self.decode is fast_comma_decoder:
+            decoded = self.decode(data, out=self.ring[self.ring_count % self.ring_size])
+        else:
+            decoded = self.decode(data)
+        if decoded is None:
+            return None
+        if self.ring is None:
+            n_channels = self.n_channels if self.n_channels is not None else decoded.size
+            self.ring = np.empty((self.ring_size, n_channels), dtype=np.float64)
+
+        row = self.ring[self.ring_count % self.ring_size]
+        if decoded is not row:
+            if decoded.shape != row.shape:
+                return decoded
+            row[:] = decoded
+        self.ring_count += 1
+        return row
+
+    def history(self, count):
+        if self.ring is None:
+            return None
+        count = min(count, self.ring_count, self.ring_size)
+        end = self.ring_count % self.ring_size
+        if end >= count:
+            return self.ring[end - count:end]
+        return np.concatenate((self.ring[end - count:], self.ring[:end]))
+
+    def transform_batch(self, frames):
+        if self.decode is not comma_decoder and self.decode is not fast_comma_decoder:
+            decoded = [decoded for decoded in map(self.decode, frames) if decoded is not None]
+            return decoded if len(decoded) > 0 else None
+
+        sep = b',' if isinstance(frames[0], bytes) else ','
+        widths = set(frame.count(sep) for frame in frames)
+        if len(widths) == 1:
+            width = widths.pop() + 1
+            decoded = self.decode(sep.join(frames))
+            # Joining frames merges a trailing empty field with the next frame's first one, so only trust the
+            # joined decode if it produced exactly one value per field
+            if decoded is not None and decoded.size == len(frames) * width:
+                return decoded.reshape(len(frames), width)
+
+        rows = [decoded for decoded in map(self.decode, frames) if decoded is not None]
+        if len(rows) == 0:
+            return None
+        if len(set(row.shape for row in rows)) > 1:
+            return rows
+        return np.stack(rows)
+
 
+# Batches are emitted as arrays or lists of frames, which cannot be split into named ports
+class BatchDecodeLayer(BatchTransformMixin, DecodeLayer):
+    def _register_port(self, port, auto=False):
+        raise NameError("BatchDecodeLayer does not support named ports")
@@ -1,19 +1,51 @@
+import os
 import time
 
 from pyrealtime.layer import ProducerMixin, ThreadLayer
 
 
+# Paces frames against absolute deadlines so time spent generating a frame does not accumulate as drift.
+# If the caller falls more than a full period behind, the schedule restarts instead of bursting to catch up.
+class FrameTimer(object):
+    def __init__(self, rate):
+        self.period = 1.0 / rate
+        self.deadline = None
+
+    def wait(self, stop_event=None):
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        self.deadline += self.period
+        delay = self.deadline - now
+        if delay > 0:
+            if stop_event is not None:
+                stop_event.wait(delay)
+            else:
+                time.sleep(delay)
+        elif delay < -self.period:
+            self.deadline = now
+
+
+# Input layers set the timing of the whole pipeline. Setting PYRT_RT=1 runs them with SCHED_FIFO scheduling
+# (which usually requires elevated privileges) to reduce wake-up jitter.
+def realtime_default():
+    return os.environ.get('PYRT_RT') == '1'
+
+
 class InputLayer(ProducerMixin, ThreadLayer):
-    def __init__(self, frame_generator=None, rate=30, *args, **kwargs):
+    def __init__(self, frame_generator=None, rate=30, queue_capacity=4, *args, **kwargs):
+        kwargs.setdefault('realtime', realtime_default())
+        self.queue_capacity = queue_capacity
         super().__init__( *args, **kwargs)
         self._generate = frame_generator if frame_generator is not None else self.generate
         self.rate = rate
+        self.timer = FrameTimer(rate)
 
     def generate(self, counter):
         return counter
 
     def get_input(self):
-        time.sleep(1.0/self.rate)
+        self.timer.wait(self.stop_event)
         data = self._generate(self.counter)
         self.tick()
         return data
@@ -47,6 +79,7 @@ class OneShotInputLayer(ProducerMixin, ThreadLayer):
 
 class MultipleShotInputLayer(ProducerMixin, ThreadLayer):
     def __init__(self, num_shots=1, completion_handler=None, frame_generator=None, rate=30, finish=False, *args, **kwargs):
+        kwargs.setdefault('realtime', realtime_default())
         super().__init__( *args, **kwargs)
         self.rate = rate
         self._generate = frame_generator if frame_generator is not None else self.generate
@@ -54,6 +87,8 @@ class MultipleShotInputLayer(ProducerMixin, ThreadLayer):
         self.finish = finish
         self.completion_handler = completion_handler if completion_handler is not None else self.default_completion_handler
         self.expired = False
+        self.timer = FrameTimer(rate)
+        self.state = self.state_running
 
     def generate(self, counter):
         return counter
@@ -62,20 +97,25 @@ class MultipleShotInputLayer(ProducerMixin, ThreadLayer):
         print("Complete!")
 
     def get_input(self):
-        if self.counter < self.num_shots-1:
-            time.sleep(1.0/self.rate)
-            data = self._generate(self.counter)
-            self.tick()
-            return data
-        elif self.counter == self.num_shots - 1:
-            time.sleep(1.0/self.rate)
-            self.tick()
-            if self.completion_handler is not None:
-                self.completion_handler()
-            if self.finish:
-                return -1
-        else:
-            if not self.expired:
-                self.expired = True
-            time.sleep(1.0/self.rate)
-            return
+        self.timer.wait(self.stop_event)
+        return self.state()
+
+    # Shot states: running -> complete (fires once) -> expired. Each get_input call runs the current state.
+    def state_running(self):
+        if self.counter >= self.num_shots - 1:
+            self.state = self.state_complete
+            return self.state()
+        data = self._generate(self.counter)
+        self.tick()
+        return data
+
+    def state_complete(self):
+        self.state = self.state_expired
+        self.tick()
+        if self.completion_handler is not None:
+            self.completion_handler()
+        if self.finish:
+            return -1
+
+    def state_expired(self):
+        self.expired = True
@@ -1,11 +1,14 @@
+import os
 import queue
 import threading
 import multiprocessing
-from datetime import datetime, timedelta
-from time import sleep
+from datetime import timedelta
+from time import sleep, monotonic_ns
 from enum import Enum
+from warnings import warn
 
 from pyrealtime.layer_manager import LayerManager
+from pyrealtime.queues import make_queue, put_latest, InputWaiter
 
 
 class LayerTrigger(Enum):
@@ -19,8 +22,12 @@ class LayerSignal(Enum):
     STOP = 0
 
 
+# Enum members are singletons (also after unpickling), so signals are checked by identity
+_STOP = LayerSignal.STOP
+
+
 class BasePort(object):
-    def get_output(self):
+    def get_output(self, thread_local=False, ready_event=None):
         raise NotImplementedError
 
     def handle_output(self, data):
@@ -28,30 +35,73 @@ class BasePort(object):
 
 
 class Port(BasePort):
-    def __init__(self):
-        self.out_queues = []
-
-    def get_output(self):
-        ctx = multiprocessing.get_context('spawn')
-        out_queue = ctx.Queue()
-        self.out_queues.append(out_queue)
+    def __init__(self, layer=None):
+        self.layer = layer
+        self.out_queues_mp = []
+        self.out_queues_thread = []
+        self.ready_events = []
+
+    def get_output(self, thread_local=False, ready_event=None):
+        out_queue = self.make_queue(thread_local)
+        if thread_local:
+            self.out_queues_thread.append(out_queue)
+        else:
+            self.out_queues_mp.append(out_queue)
+        # Consumers wait on the pipe of multiprocessing queues rather than on the event
+        if ready_event is not None and getattr(out_queue, 'connection', None) is None:
+            self.ready_events.append(ready_event)
         return out_queue
 
     def handle_output(self, data):
         if data is not None:
-            for queue in self.out_queues:
-                queue.put(data)
+            for out_queue in self.out_queues_thread:
+                out_queue.put(data)
+            for out_queue in self.out_queues_mp:
+                out_queue.put(data)
+            for event in self.ready_events:
+                event.set()
+
+    def make_queue(self, thread_local):
+        return make_queue(thread_local)
+
+
+# Port for realtime producers. Each consumer queue holds at most `capacity` items and the oldest item is dropped
+# when a new one arrives, so a slow consumer sees recent data instead of building up a backlog.
+class RingPort(Port):
+    def __init__(self, layer=None, capacity=4):
+        super().__init__(layer)
+        self.capacity = capacity
+
+    def make_queue(self, thread_local):
+        return make_queue(thread_local, self.capacity)
+
+    def handle_output(self, data):
+        if data is not None:
+            for out_queue in self.out_queues_thread:
+                out_queue.put(data)
+            for out_queue in self.out_queues_mp:
+                put_latest(out_queue, data)
+            for event in self.ready_events:
+                event.set()
 
 
 class BaseOutputLayer(BasePort):
+    # If set, every output port of the layer is a RingPort holding at most this many items per consumer
+    queue_capacity = None
+
     def __init__(self, *args, **kwargs):
-        self.out_port = Port()
+        self.out_port = self.make_port()
+
+    def make_port(self):
+        if self.queue_capacity is not None:
+            return RingPort(self, self.queue_capacity)
+        return Port(self)
 
     def handle_output(self, data):
         self.out_port.handle_output(data)
 
-    def get_output(self):
-        return self.out_port.get_output()
+    def get_output(self, thread_local=False, ready_event=None):
+        return self.out_port.get_output(thread_local, ready_event)
 
 
 class BaseInputLayer(object):
@@ -73,24 +123,27 @@ class BaseLayer(BaseInputLayer, BaseOutputLayer):
         self.set_signal_in(signal_in)
 
         self.count = 0
-        self.start_time = None
+        self.start_time_ns = None
         self.reset()
         self.time_window = time_window
+        self.time_window_ns = int(time_window.total_seconds() * 1e9)
         self.print_fps = print_fps
         self.fps = 0
 
     def tick(self):
-        t = datetime.now()
+        t = monotonic_ns()
         self.count += 1
-        if t - self.start_time >= self.time_window:
-            self.fps = self.count / (t - self.start_time).total_seconds()
+        dt = t - self.start_time_ns
+        if dt >= self.time_window_ns:
+            self.fps = self.count * 1e9 / dt
             if self.print_fps:
                 print(self.fps)
-            self.reset()
+            self.count = 0
+            self.start_time_ns = t
 
     def reset(self):
         self.count = 0
-        self.start_time = datetime.now()
+        self.start_time_ns = monotonic_ns()
 
     def post_init(self, data):
         pass
@@ -121,41 +174,54 @@ class BaseLayer(BaseInputLayer, BaseOutputLayer):
         pass
 
     def process_loop(self):
-        while not self.stop_event.is_set():
-            data = self.get_input()
-            if isinstance(data, LayerSignal) and data == LayerSignal.STOP:
-                self.stop()
-                continue
-
-            if data is None:
-                continue
-
-            self.get_signal()
-            if self.is_first:
-                self.post_init(data)
-                self.is_first = False
-            data_transformed = self.transform(data)
-            if data_transformed is None:
-                continue
-            self.handle_output(data_transformed)
-            self.tick()
-            if isinstance(data, LayerSignal) and data_transformed == LayerSignal.STOP:
-                self.stop()
-            self.counter += 1
+        # Bound methods are looked up once rather than on every message
+        is_stopped = self.stop_event.is_set
+        get_input = self.get_input
+        process_message = self.process_message
+        while not is_stopped():
+            process_message(get_input())
         self.handle_output(LayerSignal.STOP)
         self.shutdown()
 
+    def process_message(self, data):
+        if data is _STOP:
+            self.stop()
+            return
+
+        if data is None:
+            return
+
+        self.get_signal()
+        if self.is_first:
+            self.post_init(data)
+            self.is_first = False
+        data_transformed = self.transform(data)
+        if data_transformed is None:
+            return
+        self.handle_output(data_transformed)
+        self.tick()
+        if data_transformed is _STOP:
+            self.stop()
+        self.counter += 1
+
     def shutdown(self):
         pass
 
     def join(self):
         raise NotImplementedError
 
+    def get_process(self):
+        return None
+
 
 class ThreadLayer(BaseLayer):
-    def __init__(self, parent_proc=None, *args, **kwargs):
+    def __init__(self, parent_proc=None, *args, affinity=None, nice=None, realtime=False, **kwargs):
         # print("thread layer init")
         super().__init__(*args, **kwargs)
+        self.parent_proc = parent_proc
+        self.affinity = affinity
+        self.nice = nice
+        self.realtime = realtime
         if parent_proc is not None:
             self.thread = parent_proc.register_child_thread(self)
         else:
@@ -167,9 +233,23 @@ class ThreadLayer(BaseLayer):
         self.thread.daemon = True
 
     def run_thread(self):
+        self.set_scheduling()
         self.initialize()
         self.process_loop()
 
+    def set_scheduling(self):
+        # Applies to the calling thread only (pid 0), so this must run on the layer's own thread
+        try:
+            if self.affinity is not None:
+                os.sched_setaffinity(0, self.affinity)
+            if self.nice is not None:
+                os.nice(self.nice)
+            if self.realtime:
+                priority = os.sched_get_priority_min(os.SCHED_FIFO)
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except (AttributeError, OSError) as e:
+            warn("Could not set scheduling for layer %s: %s" % (self.name, e))
+
     def start(self, *args, **kwargs):
         super(ThreadLayer, self).start(*args, **kwargs)
         self.thread.start()
@@ -177,6 +257,9 @@ class ThreadLayer(BaseLayer):
     def join(self):
         self.thread.join()
 
+    def get_process(self):
+        return self.parent_proc
+
 
 class ProcessLayer(BaseLayer):
 
@@ -210,6 +293,9 @@ class ProcessLayer(BaseLayer):
     def join(self):
         self.process.join()
 
+    def get_process(self):
+        return self
+
     def init_child_threads(self):
         for thread_layer in self.thread_layers:
             thread_layer.create_thread()
@@ -222,6 +308,7 @@ class MultiOutputMixin(BaseOutputLayer):
     def __init__(self, *args, **kwargs):
         self.ports = {}
         self.auto_ports = {}
+        self.port_items = []
         super().__init__(*args, **kwargs)
 
     def get_port(self, port):
@@ -238,21 +325,17 @@ class MultiOutputMixin(BaseOutputLayer):
         port_list = self.ports if auto is False else self.auto_ports
         if port in port_list:
             raise NameError("Port %s already exists" % port)
-        port_list[port] = Port()
+        port_list[port] = self.make_port()
+        self.port_items.append((port, port_list[port]))
 
     def handle_output(self, data):
         if data is not None:
-            for key in list(self.ports.keys()) + list(self.auto_ports.keys()):
-                if key in self.ports:
-                    port = self.ports[key]
-                elif key in self.auto_ports:
-                    port = self.auto_ports[key]
-                else:
-                    raise NameError("Port %s does not exist" % key)
+            for key, port in self.port_items:
                 try:
-                    port.handle_output(data[key])
+                    value = data[key]
                 except KeyError:
-                    pass
+                    continue
+                port.handle_output(value)
         super().handle_output(data)
 
 
@@ -268,18 +351,63 @@ class TransformMixin(BaseInputLayer):
     def __init__(self, port_in, trigger=LayerTrigger.SLOWEST, trigger_source=None, discard_old=False, *args, **kwargs):
         self.ports_in = {}
         self.keys = []
+        self.get_funcs = []
+        self.drain_funcs = []
         self.discard_old = discard_old
-        if port_in is not None:
-            self.set_input(port_in)
         self.trigger = trigger
         self.trigger_source = trigger_source
+        # Set by input ports without a pipe after they enqueue, so get_any can block instead of polling. Inputs
+        # may come from other processes (faster_fifo queues), so this has to be a multiprocessing event.
+        self.any_ready = None
+        if trigger == LayerTrigger.FASTEST:
+            self.any_ready = multiprocessing.get_context('spawn').Event()
+        # Created on the first get_any, in the process the layer runs in
+        self.any_waiter = None
         super().__init__(*args, **kwargs)
+        if port_in is not None:
+            self.set_input(port_in)
 
     def set_input(self, port_in, key='default'):
         assert(isinstance(port_in, BasePort))
         assert(key not in self.keys)
         self.keys.append(key)
-        self.ports_in[key] = port_in.get_output()
+        self.ports_in[key] = port_in.get_output(thread_local=self.is_thread_local(port_in),
+                                                ready_event=self.any_ready)
+        self.get_funcs.append(self.ports_in[key].get)
+        self.drain_funcs.append(self.ports_in[key].drain)
+        LayerManager.add_edge(port_in, self, key)
+        self.specialize_input()
+
+    def specialize_input(self):
+        # With a single unnamed input, bind get_input straight to the queue so each message skips the trigger
+        # dispatch and the dict wrapping. Subclasses that override get_input are left alone.
+        self.__dict__.pop('get_input', None)
+        if type(self).get_input is not TransformMixin.get_input or self.keys != ['default']:
+            return
+        if self.trigger == LayerTrigger.TIMER:
+            self.get_input = self.get_default_nowait
+        elif self.trigger == LayerTrigger.SLOWEST and self.discard_old:
+            self.get_input = self.get_default_latest
+        else:
+            self.get_input = self.ports_in['default'].get
+
+    def get_default_nowait(self):
+        sleep(self.trigger_source)
+        data = {}
+        self._get_nowait('default', self.discard_old, data)
+        return data.get('default')
+
+    def get_default_latest(self):
+        in_queue = self.ports_in['default']
+        latest = in_queue.drain()
+        return latest[-1] if latest else in_queue.get()
+
+    def is_thread_local(self, port_in):
+        # Inputs produced in the same process as this layer skip pickling and are passed by reference
+        source = port_in.layer if isinstance(port_in, Port) else port_in
+        if not isinstance(source, BaseLayer) or not isinstance(self, BaseLayer):
+            return False
+        return source.get_process() is self.get_process()
 
     def get_input(self):
         data = None
@@ -301,43 +429,43 @@ class TransformMixin(BaseInputLayer):
 
     def get_all(self, discard_old):
         data = {}
-        for key in self.keys:
-            data[key] = self.ports_in[key].get()
-            if discard_old:
-                try:
-                    while True:
-                        data[key] = self.ports_in[key].get_nowait()
-                except queue.Empty:
-                    pass
+        if discard_old:
+            for key, drain, get in zip(self.keys, self.drain_funcs, self.get_funcs):
+                latest = drain()
+                data[key] = latest[-1] if latest else get()
+        else:
+            for key, get in zip(self.keys, self.get_funcs):
+                data[key] = get()
         return data
 
     def get_all_nowait(self, discard_old):
         data = {}
         for key in self.keys:
-            try:
-                while True:
-                    data[key] = self.ports_in[key].get_nowait()
-                    if not discard_old:
-                        break
-            except queue.Empty:
-                pass
+            self._get_nowait(key, discard_old, data)
         return data
 
+    def _get_nowait(self, key, discard_old, data):
+        if discard_old:
+            latest = self.ports_in[key].drain()
+            if latest:
+                data[key] = latest[-1]
+            return
+        try:
+            data[key] = self.ports_in[key].get_nowait()
+        except queue.Empty:
+            pass
+
     def get_any(self):
-        value = None
-        data = {}
-        sleep_time = 0.001
+        if self.any_waiter is None:
+            self.any_waiter = InputWaiter([self.ports_in[key] for key in self.keys], self.any_ready)
         while True:
+            self.any_waiter.prepare()
             for key in self.keys:
                 try:
-                    value = self.ports_in[key].get_nowait()
+                    return {key: self.ports_in[key].get_nowait()}
                 except queue.Empty:
                     pass
-                if value is not None:
-                    data[key] = value
-                    return data
-            sleep(sleep_time)
-            sleep_time *= 2
+            self.any_waiter.wait()
 
     def get_ensure_layer(self, layer, discard_old):
         data = {}
@@ -347,16 +475,31 @@ class TransformMixin(BaseInputLayer):
         for key in self.keys:
             if key == layer:
                 continue
-            try:
-                while True:
-                    data[key] = self.ports_in[key].get_nowait()
-                    if not discard_old:
-                        break
-            except queue.Empty:
-                pass
+            self._get_nowait(key, discard_old, data)
         return data
 
 
+# Transform mixin for a single input that hands every frame queued since the last call to transform_batch(),
+# which the layer must define, so a backed-up input costs one transform and one output per batch instead of
+# one per frame.
+class BatchTransformMixin(TransformMixin):
+
+    def get_input(self):
+        in_queue = self.ports_in['default']
+        batch = in_queue.drain()
+        return batch if batch else [in_queue.get()]
+
+    def process_message(self, batch):
+        frames = [data for data in batch if data is not None and not isinstance(data, LayerSignal)]
+        if len(frames) > 0:
+            super().process_message(frames)
+        if any(data is _STOP for data in batch):
+            self.stop()
+
+    def transform(self, data):
+        return self.transform_batch(data)
+
+
 class MergeLayer(TransformMixin, ThreadLayer):
     pass
 
@@ -364,4 +507,49 @@ class MergeLayer(TransformMixin, ThreadLayer):
 class TransformLayer(TransformMixin, ThreadLayer):
     def __init__(self, port_in, transformer, *args, **kwargs):
         self.transform = transformer
-        super().__init__(port_in, *args, **kwargs)
\ No newline at end of file
+        super().__init__(port_in, *args, **kwargs)
+
+
+class FusedTransform(object):
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def __call__(self, data):
+        data = self.first(data)
+        if data is None or data is _STOP:
+            return data
+        return self.second(data)
+
+
+def can_fuse(source, layer):
+    if type(source) is not TransformLayer or type(layer) is not TransformLayer:
+        return False
+    if layer.keys != ['default'] or layer.trigger != LayerTrigger.SLOWEST or layer.discard_old:
+        return False
+    if layer.signal_in is not None or layer.print_fps or source.get_process() is not layer.get_process():
+        return False
+    port = source.out_port
+    return len(port.out_queues_mp) == 0 and len(port.ready_events) == 0 and \
+        port.out_queues_thread == [layer.ports_in['default']]
+
+
+# Collapses chains of plain TransformLayers, where a layer is the only consumer of another layer in the same
+# process, into the first layer of the chain. The first layer runs the composed transforms and takes over the
+# output port of the last one, so the queues between them are never used.
+def fuse_transform_layers(edges):
+    fused_into = {}
+    for (port_in, layer, key) in edges:
+        source = port_in
+        while source in fused_into:
+            source = fused_into[source]
+        if not can_fuse(source, layer):
+            continue
+        source.transform = FusedTransform(source.transform, layer.transform)
+        source.out_port = layer.out_port
+        source.out_port.layer = source
+        fused_into[layer] = source
+        if layer in LayerManager.layers:
+            LayerManager.layers.remove(layer)
+        if layer.parent_proc is not None:
+            layer.parent_proc.thread_layers.remove(layer)
@@ -1,4 +1,5 @@
 import multiprocessing
+import os
 
 import time
 from warnings import warn
@@ -6,12 +7,14 @@ from warnings import warn
 
 class LayerManager:
     layers = []
+    edges = []
     stop_event = multiprocessing.Event()
     input_prompts = multiprocessing.Queue()
 
     @staticmethod
     def reset():
         LayerManager.layers = []
+        LayerManager.edges = []
         LayerManager.stop_event = multiprocessing.Event()
         LayerManager.input_prompts = multiprocessing.Queue()
 
@@ -20,6 +23,15 @@ class LayerManager:
         LayerManager.layers.append(layer)
         return layer
 
+    @staticmethod
+    def add_edge(port_in, layer, key):
+        LayerManager.edges.append((port_in, layer, key))
+
+    @staticmethod
+    def fuse_layers():
+        from pyrealtime.layer import fuse_transform_layers
+        fuse_transform_layers(LayerManager.edges)
+
     @staticmethod
     def start():
         warn("LayerManager.start renamed to LayerManager.run")
@@ -27,6 +39,7 @@ class LayerManager:
 
     @staticmethod
     def run():
+        LayerManager.fuse_layers()
         for layer in LayerManager.layers:
             layer.start(LayerManager.stop_event)
 
@@ -39,6 +52,29 @@ class LayerManager:
 
         LayerManager.reset()
 
+    @staticmethod
+    def run_pool(num_workers=None):
+        from pyrealtime.scheduler import LayerPool
+
+        LayerManager.fuse_layers()
+        pooled = [layer for layer in LayerManager.layers if LayerPool.can_schedule(layer)]
+        pool = LayerPool(pooled, num_workers if num_workers is not None else os.cpu_count())
+        for layer in LayerManager.layers:
+            if layer not in pooled:
+                layer.start(LayerManager.stop_event)
+        pool.start(LayerManager.stop_event)
+
+        while not LayerManager.stop_event.is_set():
+            LayerManager.handle_input()
+            time.sleep(0.1)
+
+        pool.join()
+        for layer in LayerManager.layers:
+            if layer not in pooled:
+                layer.join()
+
+        LayerManager.reset()
+
     @staticmethod
     def handle_input():
         if not LayerManager.input_prompts.empty():
@@ -0,0 +1,215 @@
+import queue
+import threading
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.queues
+from collections import deque
+
+try:
+    import faster_fifo
+except ImportError:
+    faster_fifo = None
+
+
+FAST_QUEUE_BYTES = 1 << 22
+use_fast_queue = False
+
+
+# Opt in to faster_fifo for cross-process queues. Each queue is a fixed FAST_QUEUE_BYTES buffer: a message larger
+# than the buffer raises ValueError, and once a stalled consumer fills the buffer the producer blocks until there is
+# room. multiprocessing.Queue (the default) has neither limit. Call before creating layers.
+def use_fast_queues(enabled=True):
+    global use_fast_queue
+    if enabled and faster_fifo is None:
+        raise ImportError("faster_fifo is not installed")
+    use_fast_queue = enabled
+
+
+# Queue for edges whose producer and consumer live in the same process. Items are passed by reference
+# instead of being pickled through a pipe. With a capacity, putting into a full queue drops the oldest item.
+class ThreadQueue(object):
+    def __init__(self, capacity=None):
+        self.items = deque(maxlen=capacity)
+        self.not_empty = threading.Condition(threading.Lock())
+        self.listeners = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['not_empty']
+        state['listeners'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.not_empty = threading.Condition(threading.Lock())
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_empty:
+            self.items.append(item)
+            self.not_empty.notify()
+        for listener in self.listeners:
+            listener()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if block:
+                if not self.not_empty.wait_for(lambda: self.items, timeout):
+                    raise queue.Empty
+            elif not self.items:
+                raise queue.Empty
+            return self.items.popleft()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def drain(self):
+        with self.not_empty:
+            items = list(self.items)
+            self.items.clear()
+        return items
+
+    def empty(self):
+        return not self.items
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def qsize(self):
+        return len(self.items)
+
+
+if faster_fifo is not None:
+    # faster_fifo.Queue times out blocking calls after 10s by default; block indefinitely like
+    # multiprocessing.Queue unless a timeout is given.
+    class FastQueue(faster_fifo.Queue):
+        def __init__(self, max_size_bytes=FAST_QUEUE_BYTES, maxsize=None, *args, **kwargs):
+            if maxsize is not None:
+                kwargs['maxsize'] = maxsize
+            super().__init__(max_size_bytes, *args, **kwargs)
+
+        def put(self, item, block=True, timeout=None):
+            while True:
+                try:
+                    if timeout is not None or not block:
+                        return super().put(item, block, timeout if timeout is not None else 0.0)
+                    return super().put(item, True, 1.0)
+                except queue.Full:
+                    # A message that does not fit into an empty buffer never will
+                    if self.empty():
+                        try:
+                            return super().put(item, False, 0.0)
+                        except queue.Full:
+                            raise ValueError("Message does not fit in a %d byte queue" % self.max_size_bytes)
+                    if timeout is not None or not block:
+                        raise
+
+        def put_nowait(self, item):
+            return self.put(item, block=False)
+
+        def get(self, block=True, timeout=None):
+            if timeout is not None or not block:
+                return super().get(block, timeout if timeout is not None else 0.0)
+            while True:
+                try:
+                    return super().get(True, 1.0)
+                except queue.Empty:
+                    pass
+
+        def drain(self):
+            try:
+                return self.get_many_nowait()
+            except queue.Empty:
+                return []
+else:
+    FastQueue = None
+
+
+class ProcessQueue(multiprocessing.queues.Queue):
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize, ctx=multiprocessing.get_context('spawn'))
+
+    # Readable once an item has reached the pipe
+    @property
+    def connection(self):
+        return self._reader
+
+    def drain(self):
+        items = []
+        try:
+            while True:
+                items.append(self.get_nowait())
+        except queue.Empty:
+            pass
+        return items
+
+
+def make_queue(thread_local=False, capacity=None):
+    if thread_local:
+        return ThreadQueue(capacity)
+    if use_fast_queue:
+        return FastQueue(maxsize=capacity)
+    return ProcessQueue(capacity if capacity is not None else 0)
+
+
+# Put without blocking, dropping the oldest queued item to make room. Gives up after a few attempts (e.g. when
+# the consumer is racing for the same slot) and drops the new item instead. Returns whether the item was queued.
+def put_latest(out_queue, item, attempts=3):
+    for _ in range(attempts):
+        try:
+            out_queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        try:
+            # multiprocessing queues can report Full before the queued items are readable, so wait briefly
+            out_queue.get(True, 0.01)
+        except queue.Empty:
+            pass
+    return False
+
+
+# Blocks a consumer until any of its input queues may have an item. Items put on a multiprocessing queue reach
+# its pipe from a feeder thread, possibly after a ready event set by the producer has already fired, so those
+# inputs are waited on through their pipes. Queues without a pipe (thread queues and faster_fifo queues, whose
+# puts are synchronous) are signalled through the ready event their port sets. When both kinds are mixed, thread
+# queues wake the wait through a pipe instead, and faster_fifo queues are polled every 10ms.
+# Call prepare() before checking the queues and wait() if they were all empty.
+class InputWaiter(object):
+    def __init__(self, in_queues, ready_event):
+        self.ready_event = ready_event
+        self.connections = [q.connection for q in in_queues if getattr(q, 'connection', None) is not None]
+        self.waiting = False
+        self.wake_reader = None
+        self.wake_writer = None
+        self.timeout = None
+        if len(self.connections) == 0:
+            return
+        thread_queues = [q for q in in_queues if isinstance(q, ThreadQueue)]
+        if len(thread_queues) > 0:
+            self.wake_reader, self.wake_writer = multiprocessing.Pipe(duplex=False)
+            self.connections.append(self.wake_reader)
+            for thread_queue in thread_queues:
+                thread_queue.subscribe(self.wake)
+        if any(getattr(q, 'connection', None) is None and not isinstance(q, ThreadQueue) for q in in_queues):
+            self.timeout = 0.01
+
+    def prepare(self):
+        self.ready_event.clear()
+        self.waiting = True
+
+    def wake(self):
+        if self.waiting:
+            self.waiting = False
+            self.wake_writer.send_bytes(b'')
+
+    def wait(self):
+        if len(self.connections) == 0:
+            self.ready_event.wait()
+            return
+        multiprocessing.connection.wait(self.connections, self.timeout)
+        self.waiting = False
+        while self.wake_reader is not None and self.wake_reader.poll():
+            self.wake_reader.recv_bytes()
@@ -0,0 +1,78 @@
+import threading
+from collections import deque
+
+from pyrealtime.layer import TransformMixin, ThreadLayer, LayerTrigger, LayerSignal
+from pyrealtime.queues import ThreadQueue
+
+
+# Runs transform layers on a fixed set of worker threads instead of one thread per layer. A layer is
+# scheduled whenever all of its inputs have data, and is never stepped by two workers at once, so each
+# layer still sees its inputs in order.
+class LayerPool(object):
+    def __init__(self, layers, num_workers):
+        self.layers = layers
+        self.num_workers = num_workers
+        self.ready = deque()
+        self.scheduled = set()
+        self.cond = threading.Condition()
+        self.workers = []
+        self.stop_event = None
+
+    @staticmethod
+    def can_schedule(layer):
+        if not isinstance(layer, TransformMixin) or not isinstance(layer, ThreadLayer):
+            return False
+        if layer.get_process() is not None or layer.trigger != LayerTrigger.SLOWEST:
+            return False
+        if type(layer).get_input is not TransformMixin.get_input or len(layer.ports_in) == 0:
+            return False
+        return all(isinstance(q, ThreadQueue) for q in layer.ports_in.values())
+
+    @staticmethod
+    def is_ready(layer):
+        return all(not q.empty() for q in layer.ports_in.values())
+
+    def notify(self, layer):
+        with self.cond:
+            if layer in self.scheduled or not self.is_ready(layer):
+                return
+            self.scheduled.add(layer)
+            self.ready.append(layer)
+            self.cond.notify()
+
+    def start(self, stop_event):
+        self.stop_event = stop_event
+        for layer in self.layers:
+            layer.stop_event = stop_event
+            layer.initialize()
+            for q in layer.ports_in.values():
+                q.subscribe(lambda layer=layer: self.notify(layer))
+            self.notify(layer)
+
+        for _ in range(self.num_workers):
+            worker = threading.Thread(target=self.run_worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def run_worker(self):
+        while True:
+            with self.cond:
+                while not self.ready and not self.stop_event.is_set():
+                    self.cond.wait(0.1)
+                if self.stop_event.is_set():
+                    return
+                layer = self.ready.popleft()
+
+            layer.process_message(layer.get_input())
+
+            with self.cond:
+                self.scheduled.discard(layer)
+            self.notify(layer)
+
+    def join(self):
+        for worker in self.workers:
+            worker.join()
+        for layer in self.layers:
+            layer.handle_output(LayerSignal.STOP)
+            layer.shutdown()
@@ -0,0 +1,117 @@
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from pyrealtime.layer import Port, LayerSignal
+from pyrealtime.queues import make_queue, put_latest
+
+
+class SharedArrayRef(object):
+    def __init__(self, name, offset, shape, dtype):
+        self.name = name
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+
+# Consumer end of a SharedArrayPort queue for a layer in another process. Rebuilds arrays from the
+# descriptors sent by the producer as views into the shared memory block, attaching to it on first use.
+class SharedArrayQueue(object):
+    def __init__(self, in_queue):
+        self.in_queue = in_queue
+        self.shm = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shm'] = None
+        return state
+
+    def resolve(self, item):
+        if not isinstance(item, SharedArrayRef):
+            return item
+        if self.shm is None or self.shm.name != item.name:
+            try:
+                self.shm = SharedMemory(name=item.name)
+            except FileNotFoundError:
+                # The producer has stopped and unlinked the block
+                return None
+        return np.ndarray(item.shape, dtype=item.dtype, buffer=self.shm.buf, offset=item.offset)
+
+    @property
+    def connection(self):
+        return getattr(self.in_queue, 'connection', None)
+
+    def get(self, block=True, timeout=None):
+        return self.resolve(self.in_queue.get(block, timeout))
+
+    def get_nowait(self):
+        return self.resolve(self.in_queue.get_nowait())
+
+    def drain(self):
+        return [self.resolve(item) for item in self.in_queue.drain()]
+
+    def empty(self):
+        return self.in_queue.empty()
+
+
+# Port that publishes NumPy arrays to other processes through a shared memory ring of `capacity` slots and
+# sends only a small descriptor through the queue. The slot size is fixed by the first array; anything that
+# does not fit, or is not an array, is pickled through the queue as usual. Consumers in the same process get
+# arrays by reference.
+#
+# An array received from this port is a view into the ring and is overwritten once `capacity` newer arrays
+# have been published. Consumer queues hold at most capacity // 2 descriptors (dropping the oldest) so that
+# queued descriptors never point at overwritten slots; copy the array to keep it longer.
+#
+# Use it by replacing a layer's port before connecting consumers: layer.out_port = SharedArrayPort(layer)
+# The shared memory block is released when the layer emits LayerSignal.STOP, in the producer's own process.
+class SharedArrayPort(Port):
+    def __init__(self, layer=None, capacity=16):
+        super().__init__(layer)
+        self.capacity = capacity
+        self.shm = None
+        self.slot_bytes = 0
+        self.slot = 0
+
+    def get_output(self, thread_local=False, ready_event=None):
+        out_queue = super().get_output(thread_local, ready_event)
+        if thread_local:
+            return out_queue
+        return SharedArrayQueue(out_queue)
+
+    def make_queue(self, thread_local):
+        return make_queue(thread_local, None if thread_local else max(1, self.capacity // 2))
+
+    def publish(self, data):
+        if not isinstance(data, np.ndarray) or data.dtype.hasobject:
+            return data
+        if self.shm is None:
+            self.slot_bytes = max(data.nbytes, 1)
+            self.shm = SharedMemory(create=True, size=self.slot_bytes * self.capacity)
+        if data.nbytes > self.slot_bytes:
+            return data
+
+        offset = self.slot * self.slot_bytes
+        self.slot = (self.slot + 1) % self.capacity
+        view = np.ndarray(data.shape, dtype=data.dtype, buffer=self.shm.buf, offset=offset)
+        np.copyto(view, data)
+        return SharedArrayRef(self.shm.name, offset, data.shape, data.dtype)
+
+    def handle_output(self, data):
+        if data is not None:
+            for out_queue in self.out_queues_thread:
+                out_queue.put(data)
+            if len(self.out_queues_mp) > 0:
+                item = self.publish(data)
+                for out_queue in self.out_queues_mp:
+                    put_latest(out_queue, item)
+            for event in self.ready_events:
+                event.set()
+            if data is LayerSignal.STOP:
+                self.close()
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
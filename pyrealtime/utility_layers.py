@@ -19,7 +19,7 @@ class PrintLayer(TransformMixin, ThreadLayer):
 class MergeLayer(TransformMixin, ThreadLayer):
     def __init__(self, ports_in, *args, **kwargs):
         super().__init__(ports_in[0], *args, **kwargs)
-        self.other_ports = [p.get_output() for p in ports_in[1:]]
+        self.other_ports = [p.get_output(thread_local=self.is_thread_local(p)) for p in ports_in[1:]]
 
     def get_input(self):
         data = {}
@@ -147,7 +147,7 @@ class BufferLayer(TransformMixin, ThreadLayer):
             self.buffer[0:-1] = self.buffer[1:]
             self.buffer[-1] = data
 
-        return self.buffer
+        return self.buffer.copy()
 
     def in_place_transform(self, data):
         assert(len(data) < self.buffer_size)
@@ -163,6 +163,7 @@ class BufferLayer(TransformMixin, ThreadLayer):
         else:
             self.buffer[0:-data_size] = self.buffer[data_size:]
             self.buffer[-data_size:] = data
+            return self.buffer.copy()
         return self.buffer
 
 